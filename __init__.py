@@ -1,17 +1,33 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import ir
 from . import move
 from . import shipment
 from . import sale
 from . import purchase
+from . import valuation
+from . import reporting
 
 def register():
     Pool.register(
+        ir.Cron,
         move.Move,
         shipment.ShipmentIn,
+        shipment.ShipmentInReturn,
         shipment.ShipmentOut,
         shipment.ShipmentOutReturn,
+        valuation.ShipmentValuation,
+        reporting.ValuationContext,
+        reporting.Valuation,
+        module='stock_valued', type_='model')
+    Pool.register(
+        sale.SaleLine,
+        depends=['sale'],
+        module='stock_valued', type_='model')
+    Pool.register(
+        purchase.PurchaseLine,
+        depends=['purchase'],
         module='stock_valued', type_='model')
     Pool.register(
         sale.SaleLineDiscount,
@@ -0,0 +1,107 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from trytond import config
+
+__all__ = ['instrumented', 'get_stats', 'reset_stats']
+
+logger = logging.getLogger(__name__)
+
+ENABLED = config.getboolean('stock_valued', 'instrument', default=False)
+_BACKEND_LOGGERS = [
+    'trytond.backend.sqlite.database',
+    'trytond.backend.postgresql.database',
+    ]
+_local = threading.local()
+_lock = threading.Lock()
+_stats = defaultdict(lambda: {
+        'calls': 0,
+        'records': 0,
+        'queries': 0,
+        'time': 0.,
+        'max_time': 0.,
+        })
+
+
+class _QueryCounter(logging.Filter):
+    "Count the queries logged by a backend and hide them if not wanted"
+
+    def __init__(self, log_queries):
+        super().__init__()
+        self.log_queries = log_queries
+
+    def filter(self, record):
+        if record.levelno == logging.DEBUG:
+            _local.queries = _queries() + 1
+            return self.log_queries
+        return True
+
+
+def _queries():
+    return getattr(_local, 'queries', 0)
+
+
+def _install():
+    # The backends log the queries only when debug is enabled at connection
+    for name in _BACKEND_LOGGERS:
+        backend_logger = logging.getLogger(name)
+        backend_logger.addFilter(
+            _QueryCounter(backend_logger.isEnabledFor(logging.DEBUG)))
+        backend_logger.setLevel(logging.DEBUG)
+
+
+if ENABLED:
+    _install()
+
+
+def _record_count(args):
+    if len(args) > 1 and isinstance(args[1], (list, tuple)):
+        return len(args[1])
+    return 1
+
+
+def instrumented(func):
+    '''
+    Record the calls, records, queries and time of the method when the
+    instrument option of the stock_valued section is set
+    '''
+    if not ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        name = '%s.%s' % (args[0].__name__, func.__name__)
+        records = _record_count(args)
+        queries = _queries()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            queries = _queries() - queries
+            with _lock:
+                stat = _stats[name]
+                stat['calls'] += 1
+                stat['records'] += records
+                stat['queries'] += queries
+                stat['time'] += elapsed
+                stat['max_time'] = max(stat['max_time'], elapsed)
+            logger.debug(
+                "%s: %s records, %s queries, %.3fs",
+                name, records, queries, elapsed)
+    return wrapper
+
+
+def get_stats():
+    "Return the statistics of the instrumented methods by name"
+    with _lock:
+        return {n: dict(s) for n, s in _stats.items()}
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,23 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('stock.shipment.in|rebuild_cache',
+                    "Rebuild Supplier Shipment Amounts Cache"),
+                ('stock.shipment.in.return|rebuild_cache',
+                    "Rebuild Supplier Return Shipment Amounts Cache"),
+                ('stock.shipment.out|rebuild_cache',
+                    "Rebuild Customer Shipment Amounts Cache"),
+                ('stock.shipment.out.return|rebuild_cache',
+                    "Rebuild Customer Return Shipment Amounts Cache"),
+                ('stock.shipment.valuation|rebuild',
+                    "Rebuild Shipment Valuation"),
+                ])
@@ -1,14 +1,29 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from decimal import Decimal
-from trytond.model import fields
+import threading
+from collections import OrderedDict, defaultdict
+from decimal import ROUND_HALF_EVEN, Decimal
+from sql import Null
+from sql.operators import Concat
+from trytond import config
+from trytond.model import Index, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Equal, Eval, Not
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from trytond.modules.product import price_digits, round_price
 from trytond.modules.currency.fields import Monetary
 from trytond.modules.discount_formula.discount import DiscountMixin
 
+from .instrument import instrumented
+from .shipment import (
+    ShipmentValuedMixin, _get_skipped_cache, _write_rows)
+
 _ZERO = Decimal(0)
+_FORMULA_CACHE_SIZE = config.getint(
+    'stock_valued', 'formula_cache_size', default=1024)
+_formula_cache = OrderedDict()
+_formula_lock = threading.Lock()
 STATES = {
     'invisible': Not(Equal(Eval('state', ''), 'done')),
     }
@@ -29,24 +44,94 @@ class Move(metaclass=PoolMeta):
                 'invisible': ~Eval('unit_price_required'),
                 'readonly': Eval('state') != 'draft',
                 }),
-        'on_change_with_discount_rate', setter='set_discount_rate')
-    discount_amount = fields.Function(Monetary(
-            "Discount Amount", currency='currency', digits=price_digits,
-            states={
-                'invisible': ~Eval('unit_price_required'),
-                'readonly': Eval('state') != 'draft',
-                }),
-        'on_change_with_discount_amount', setter='set_discount_amount')
+        'get_discounts', setter='set_discount_rate')
+    discount_amount = Monetary(
+        "Discount Amount", currency='currency', digits=price_digits,
+        states={
+            'invisible': ~Eval('unit_price_required'),
+            'readonly': Eval('state') != 'draft',
+            })
     discount = fields.Function(fields.Char(
             "Discount",
             states={
                 'invisible': ~Eval('discount'),
                 }),
-        'on_change_with_discount')
+        'get_discounts')
     taxes = fields.Function(fields.Many2Many('account.tax', None, None,
         'Taxes'), 'get_taxes')
-    amount = fields.Function(Monetary('Amount', digits='currency',
-        currency='currency'), 'on_change_with_amount')
+    amount = Monetary('Amount', digits='currency', currency='currency',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # The fields that change the amounts of the valued shipments, the
+        # state changes them only to or from cancelled
+        cls._shipment_valued_fields = {
+            'quantity', 'unit_price', 'base_price', 'currency', 'origin',
+            'product', 'from_location', 'to_location', 'shipment',
+            }
+        cls._allow_modify_closed_period |= {'amount', 'discount_amount'}
+
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.amount, Index.Range())))
+
+    @classmethod
+    def __post_setup__(cls):
+        super().__post_setup__()
+        # The origins do not change once the pool is set up
+        cls._origin_move = 'stock.move' in cls._get_origin()
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_amounts = not table_h.column_exist('amount')
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: store amount and discount amount
+        if fill_amounts:
+            cls._fill_amounts()
+
+    @classmethod
+    def _fill_amounts(cls, chunk=1000):
+        "Fill amount and discount amount of the moves by chunks of ids"
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        currency = Currency.__table__()
+
+        cursor.execute(*currency.select(currency.id, currency.rounding))
+        roundings = dict(cursor)
+
+        last_id = 0
+        while True:
+            cursor.execute(*table.select(
+                    table.id, table.quantity, table.unit_price,
+                    table.base_price, table.currency,
+                    where=table.id > last_id,
+                    order_by=table.id.asc,
+                    limit=chunk))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            to_write = defaultdict(list)
+            for id_, quantity, unit_price, base_price, currency_id in rows:
+                amount = Decimal(str(quantity or 0)) * (unit_price or 0)
+                if roundings.get(currency_id):
+                    amount = Currency._round(
+                        amount, roundings[currency_id], ROUND_HALF_EVEN)
+                discount_amount = None
+                if unit_price is not None and base_price is not None:
+                    discount_amount = round_price(base_price - unit_price)
+                to_write[amount, discount_amount].append(id_)
+            for (amount, discount_amount), ids in to_write.items():
+                cursor.execute(*table.update(
+                        [table.amount, table.discount_amount],
+                        [amount, discount_amount],
+                        where=reduce_ids(table.id, ids)))
+            last_id = rows[-1][0]
 
     @classmethod
     def view_attributes(cls):
@@ -98,35 +183,110 @@ class Move(metaclass=PoolMeta):
             self.discount = self.on_change_with_discount()
             self.amount = self.on_change_with_amount()
 
-    @classmethod
-    def set_discount_amount(cls, lines, name, value):
-        pass
-
     @fields.depends('currency',
         methods=[
             'on_change_with_discount_rate', 'on_change_with_discount_amount'])
     def on_change_with_discount(self, name=None):
         pool = Pool()
         Lang = pool.get('ir.lang')
-        lang = Lang.get()
-        rate = self.on_change_with_discount_rate()
+        return self._format_discount(Lang.get(),
+            self.on_change_with_discount_rate(),
+            self.on_change_with_discount_amount(), self.currency)
+
+    @classmethod
+    def _format_discount(cls, lang, rate, amount, currency):
         if not rate or rate % Decimal('0.01'):
-            amount = self.on_change_with_discount_amount()
-            if amount and self.currency:
-                return lang.currency(
-                    amount, self.currency, digits=price_digits[1])
+            if amount and currency:
+                return lang.currency(amount, currency, digits=price_digits[1])
         else:
             return lang.format('%i', rate * 100) + '%'
 
-    def get_taxes(self, name):
-        taxes = []
-        if self.origin and self.origin != self and hasattr(self.origin, 'taxes'):
-            for tax in self.origin.taxes:
-                taxes.append(tax.id)
-        elif self.product and self.from_location.type == 'supplier':
-            for tax in self.product.supplier_taxes_used:
-                taxes.append(tax.id)
-        return taxes
+    @classmethod
+    def get_discounts(cls, moves, names):
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        lang = Lang.get()
+
+        result = {n: {} for n in names}
+        discounts = {}
+        for move in moves:
+            rate = move.on_change_with_discount_rate()
+            if 'discount_rate' in result:
+                result['discount_rate'][move.id] = rate
+            if 'discount' in result:
+                amount = move.discount_amount
+                key = (rate, amount, move.currency)
+                if key not in discounts:
+                    discounts[key] = cls._format_discount(
+                        lang, rate, amount, move.currency)
+                result['discount'][move.id] = discounts[key]
+        return result
+
+    @classmethod
+    @instrumented
+    def _prefetch_origins(cls, moves):
+        '''
+        Return the origin of the moves and of their stock.move origins by move
+        id. The origins of the same model are browsed together with the fields
+        used to value the moves so they are read with one query per model.
+        '''
+        pool = Pool()
+        origins = {}
+        moves = cls.browse([m.id for m in moves
+                if m.id is not None and m.id >= 0])
+        while moves:
+            model2ids = defaultdict(set)
+            for move in moves:
+                if move.origin:
+                    model2ids[move.origin.__name__].add(move.origin.id)
+            records = {}
+            for model, ids in model2ids.items():
+                Model = pool.get(model)
+                names = [n for n in ['taxes', 'unit_price', 'origin']
+                    if n in Model._fields]
+                for record in Model.browse(list(ids)):
+                    for name in names:
+                        getattr(record, name)
+                    records[model, record.id] = record
+            next_moves = []
+            for move in moves:
+                origin = move.origin
+                if origin:
+                    origin = records[origin.__name__, origin.id]
+                origins[move.id] = origin
+                if isinstance(origin, cls) and origin.id not in origins:
+                    next_moves.append(origin)
+            moves = next_moves
+        return origins
+
+    def _get_taxes(self, origins, supplier_taxes=None):
+        '''
+        Return the taxes of the move using the origins prefetched and the
+        supplier taxes already computed by product id
+        '''
+        if supplier_taxes is None:
+            supplier_taxes = {}
+        origin = origins[self.id] if self.id in origins else self.origin
+        if origin and origin != self:
+            if isinstance(origin, self.__class__):
+                return origin._get_taxes(origins, supplier_taxes)
+            elif hasattr(origin, 'taxes'):
+                return list(origin.taxes)
+        if (self.product and self.from_location
+                and self.from_location.type == 'supplier'):
+            if self.product.id not in supplier_taxes:
+                supplier_taxes[self.product.id] = list(
+                    self.product.supplier_taxes_used)
+            return supplier_taxes[self.product.id]
+        return []
+
+    @classmethod
+    @instrumented
+    def get_taxes(cls, moves, name):
+        origins = cls._prefetch_origins(moves)
+        supplier_taxes = {}
+        return {m.id: [t.id for t in m._get_taxes(origins, supplier_taxes)]
+            for m in moves}
 
     @fields.depends('quantity', 'unit_price', 'currency')
     def on_change_with_amount(self, name=None):
@@ -136,6 +296,278 @@ class Move(metaclass=PoolMeta):
             amount = self.currency.round(amount)
         return amount
 
+    @classmethod
+    def _get_amounts(cls, moves):
+        "Return the amount of the moves by id rounded grouped by currency"
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        by_currency = defaultdict(dict)
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*table.select(
+                    table.id, table.quantity, table.unit_price,
+                    table.currency,
+                    where=reduce_ids(table.id, sub_ids)))
+            for id_, quantity, unit_price, currency_id in cursor:
+                by_currency[currency_id][id_] = (
+                    Decimal(str(quantity or 0)) * (unit_price or _ZERO))
+        amounts = {}
+        for currency_id, currency_amounts in by_currency.items():
+            if currency_id is not None:
+                currency = Currency(currency_id)
+                currency_amounts = {i: currency.round(a)
+                    for i, a in currency_amounts.items()}
+            amounts.update(currency_amounts)
+        return amounts
+
+    @classmethod
+    def _set_amounts(cls, vlist):
+        '''
+        Set the amounts missing from the values of the moves to create so they
+        are stored by the creation instead of being written one by one after
+        '''
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        currencies = {c.id: c for c in Currency.browse(
+                {v['currency'] for v in vlist
+                    if v.get('currency') is not None})}
+        for values in vlist:
+            unit_price = values.get('unit_price')
+            if 'amount' not in values:
+                amount = (Decimal(str(values.get('quantity') or 0))
+                    * (unit_price or _ZERO))
+                if values.get('currency') is not None:
+                    amount = currencies[values['currency']].round(amount)
+                values['amount'] = amount
+            if ('discount_amount' not in values
+                    and unit_price is not None
+                    and values.get('base_price') is not None):
+                values['discount_amount'] = round_price(
+                    values['base_price'] - unit_price)
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        cls._set_amounts(vlist)
+        return super().create(vlist)
+
+    @classmethod
+    def _compute_fields(cls, moves, field_names=None):
+        super()._compute_fields(moves, field_names=field_names)
+        if field_names is None or (cls.amount.on_change_with & field_names):
+            amounts = cls._get_amounts(moves)
+            to_write = defaultdict(list)
+            for move in moves:
+                if move.amount != amounts[move.id]:
+                    to_write[amounts[move.id]].append(move)
+            if to_write:
+                cls.write(*[a for amount, records in to_write.items()
+                        for a in (records, {'amount': amount})])
+
+    def compute_fields(self, field_names=None):
+        cls = self.__class__
+        values = super().compute_fields(field_names=field_names)
+        if (field_names is None
+                or (cls.discount_amount.on_change_with & field_names)):
+            discount_amount = self.on_change_with_discount_amount()
+            if self.discount_amount != discount_amount:
+                values['discount_amount'] = discount_amount
+        return values
+
+    @classmethod
+    def get_valuation_rows(cls, domain=None, chunk=None):
+        "Yield the valuation of the moves matching domain by chunks of ids"
+        if chunk is None:
+            chunk = config.getint('stock_valued', 'export_chunk', default=1000)
+
+        last_id = 0
+        while True:
+            moves = cls.search([
+                    domain or [],
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=chunk)
+            if not moves:
+                break
+            discount_rates = cls.get_discounts(
+                moves, ['discount_rate'])['discount_rate']
+            for move in moves:
+                yield {
+                    'id': move.id,
+                    'shipment': str(move.shipment) if move.shipment else None,
+                    'origin': str(move.origin) if move.origin else None,
+                    'product': move.product.id,
+                    'quantity': move.quantity,
+                    'unit': move.unit.id,
+                    'state': move.state,
+                    'effective_date': move.effective_date,
+                    'currency': move.currency.code if move.currency else None,
+                    'base_price': move.base_price,
+                    'unit_price': move.unit_price,
+                    'discount_rate': discount_rates[move.id],
+                    'discount_amount': move.discount_amount,
+                    'amount': move.amount,
+                    }
+            last_id = moves[-1].id
+
+    @classmethod
+    def export_valuation(cls, file, format='csv', domain=None, chunk=None):
+        "Write the valuation of the moves to the text file"
+        _write_rows(cls.get_valuation_rows(domain, chunk), file, format)
+
+    @classmethod
+    def _get_valued_shipments(cls, moves):
+        "Return the ids of the valued shipments of moves by model"
+        shipments = defaultdict(set)
+        for move in moves:
+            if isinstance(move.shipment, ShipmentValuedMixin):
+                shipments[move.shipment.__name__].add(move.shipment.id)
+        return shipments
+
+    @classmethod
+    def _get_origins_valued_shipments(cls, origins):
+        '''
+        Return the ids of the valued shipments by model of the moves of the
+        origins or of the moves originated by their moves
+        '''
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+        move = cls.__table__()
+        origin_move = cls.__table__()
+
+        shipments = defaultdict(set)
+        for sub_origins in grouped_slice([str(o) for o in origins]):
+            sub_origins = list(sub_origins)
+            origin_moves = origin_move.select(
+                Concat(cls.__name__ + ',', origin_move.id),
+                where=origin_move.origin.in_(sub_origins))
+            cursor.execute(*move.select(move.shipment,
+                    where=(move.shipment != Null)
+                    & (move.origin.in_(sub_origins)
+                        | move.origin.in_(origin_moves)),
+                    group_by=move.shipment))
+            for shipment, in cursor:
+                model, id_ = shipment.split(',')
+                if issubclass(pool.get(model), ShipmentValuedMixin):
+                    shipments[model].add(int(id_))
+        return shipments
+
+    @classmethod
+    def _store_shipments_cache(cls, shipments):
+        pool = Pool()
+        # The shipments store their cache after their own transitions
+        skipped = _get_skipped_cache()
+        for model, ids in shipments.items():
+            ids = {i for i in ids if (model, i) not in skipped}
+            if not ids:
+                continue
+            Shipment = pool.get(model)
+            # Search as the shipments may have been deleted with their moves
+            Shipment._update_cache(Shipment.search([
+                        ('id', 'in', list(ids)),
+                        ]))
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        super().on_modification(mode, moves, field_names=field_names)
+        if (mode == 'create'
+                or (mode == 'write'
+                    and cls._shipment_valued_fields & field_names)):
+            cls._store_shipments_cache(cls._get_valued_shipments(moves))
+
+    @classmethod
+    def on_write(cls, moves, values):
+        callbacks = super().on_write(moves, values)
+        if 'shipment' in values:
+            # Previous shipments lose the moves
+            shipments = cls._get_valued_shipments(moves)
+            if shipments:
+                callbacks.append(
+                    lambda: cls._store_shipments_cache(shipments))
+        if ('state' in values
+                and not (cls._shipment_valued_fields & values.keys())):
+            # Only the cancelled moves are not valued
+            cancelled = values['state'] == 'cancelled'
+            shipments = cls._get_valued_shipments([m for m in moves
+                    if (m.state == 'cancelled') != cancelled])
+            if shipments:
+                callbacks.append(
+                    lambda: cls._store_shipments_cache(shipments))
+        return callbacks
+
+    @classmethod
+    def on_delete(cls, moves):
+        callbacks = super().on_delete(moves)
+        shipments = cls._get_valued_shipments(moves)
+        if shipments:
+            callbacks.append(lambda: cls._store_shipments_cache(shipments))
+        return callbacks
+
 
 class MoveDiscountFormula(DiscountMixin, metaclass=PoolMeta):
     __name__ = 'stock.move'
+
+    @classmethod
+    def _get_formula_prices(cls, formula):
+        '''
+        Return the unit prices by base price of the discount formula.
+        The formulas are kept by database and text in a per-process LRU cache
+        as the same formula is usually shared by many moves.
+        '''
+        key = (Transaction().database.name, formula)
+        with _formula_lock:
+            if key in _formula_cache:
+                _formula_cache.move_to_end(key)
+            else:
+                _formula_cache[key] = {}
+                if len(_formula_cache) > _FORMULA_CACHE_SIZE:
+                    _formula_cache.popitem(last=False)
+            return _formula_cache[key]
+
+    @classmethod
+    def _get_formula_unit_price(cls, formula, base_price):
+        "Return the unit price of the discount formula for the base price"
+        prices = cls._get_formula_prices(formula)
+        if base_price not in prices:
+            move = cls(base_price=base_price, discount_formula=formula)
+            move.on_change_discount_formula()
+        return prices.get(base_price)
+
+    @fields.depends('discount_formula', 'base_price',
+        methods=['on_change_with_discount_rate',
+            'on_change_with_discount_amount', 'on_change_with_discount',
+            'on_change_with_amount'])
+    def on_change_discount_formula(self):
+        if not self.discount_formula or self.base_price is None:
+            super().on_change_discount_formula()
+            return
+        prices = self._get_formula_prices(self.discount_formula)
+        if self.base_price in prices:
+            self.unit_price = prices[self.base_price]
+            self.discount_rate = self.on_change_with_discount_rate()
+            self.discount_amount = self.on_change_with_discount_amount()
+            self.discount = self.on_change_with_discount()
+            self.amount = self.on_change_with_amount()
+        else:
+            super().on_change_discount_formula()
+            unit_price = getattr(self, 'unit_price', None)
+            with _formula_lock:
+                if len(prices) >= _FORMULA_CACHE_SIZE:
+                    prices.clear()
+                prices[self.base_price] = unit_price
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        # The unit price of the moves created with a discount formula but
+        # without unit price is computed once for the same formula and price
+        for values in vlist:
+            if (values.get('unit_price') is None
+                    and values.get('discount_formula')
+                    and values.get('base_price') is not None):
+                unit_price = cls._get_formula_unit_price(
+                    values['discount_formula'], values['base_price'])
+                if unit_price is not None:
+                    values['unit_price'] = unit_price
+        return super().create(vlist)
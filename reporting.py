@@ -0,0 +1,164 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from decimal import Decimal
+from sql import Literal
+from sql.aggregate import Min, Sum
+from sql.conditionals import Case
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import timezone as tz
+from trytond.transaction import Transaction
+from trytond.modules.currency.fields import Monetary
+from trytond.modules.product import round_price
+
+
+class ValuationContext(ModelView):
+    __name__ = 'stock.reporting.valuation.context'
+    company = fields.Many2One('company.company', "Company", required=True)
+    location = fields.Many2One('stock.location', "Location", required=True,
+        domain=[
+            ('type', 'in', ['warehouse', 'storage', 'view']),
+            ])
+    date = fields.Date("Date", required=True)
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_location(cls):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        return Transaction().context.get(
+            'location', Location.get_default_warehouse())
+
+    @classmethod
+    def default_date(cls):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        return Transaction().context.get('date', Date.today())
+
+
+class Valuation(ModelSQL, ModelView):
+    __name__ = 'stock.reporting.valuation'
+    company = fields.Many2One('company.company', "Company")
+    location = fields.Many2One('stock.location', "Location")
+    product = fields.Many2One('product.product', "Product",
+        context={
+            'company': Eval('company', -1),
+            },
+        depends=['company'])
+    unit = fields.Function(fields.Many2One('product.uom', "Unit"),
+        'on_change_with_unit')
+    quantity = fields.Float("Quantity")
+    currency = fields.Many2One('currency.currency', "Currency")
+    value = fields.Function(Monetary(
+            "Value", digits='currency', currency='currency'),
+        'get_value')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('product', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        '''
+        Return the quantity of the done moves by product entering or leaving
+        the location of the context up to its date
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        context = Transaction().context
+        move = Move.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+
+        company = context.get('company')
+        currency = Company(company).currency.id if company else None
+        if location := context.get('location'):
+            location = Location(location)
+            left, right = location.left, location.right
+            location = location.id
+        else:
+            left = right = -1
+        date = context.get('date')
+
+        input_clause = (
+            (to_location.left >= left) & (to_location.right <= right))
+        output_clause = (
+            (from_location.left >= left) & (from_location.right <= right))
+        sign = Case((output_clause, -1), else_=1)
+        quantity = move.internal_quantity * sign
+
+        where = (((input_clause & ~output_clause)
+                | (output_clause & ~input_clause))
+            & (move.state == 'done')
+            & (move.company == company))
+        if date:
+            where &= move.effective_date <= date
+        return (move
+            .join(from_location,
+                condition=move.from_location == from_location.id)
+            .join(to_location,
+                condition=move.to_location == to_location.id)
+            .select(
+                Min(move.id).as_('id'),
+                Literal(company).as_('company'),
+                Literal(location).as_('location'),
+                move.product.as_('product'),
+                Sum(quantity).as_('quantity'),
+                Literal(currency).as_('currency'),
+                where=where,
+                group_by=[move.product]))
+
+    @classmethod
+    def get_value(cls, valuations, name):
+        '''
+        Return the quantity valued at the cost price of the product at the end
+        of the date like the cost value of the products
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Product = pool.get('product.product')
+        context = Transaction().context
+        values = {v.id: None for v in valuations}
+
+        product_context = {}
+        if context.get('date'):
+            # Use the last cost price of the day
+            product_context['_datetime'] = datetime.datetime.combine(
+                context['date'], datetime.time.max)
+            company = context.get('company')
+            if company is not None and company >= 0:
+                company = Company(company)
+                if company.timezone:
+                    timezone = tz.ZoneInfo(company.timezone)
+                    try:
+                        product_context['_datetime'] = (
+                            product_context['_datetime']
+                            .replace(tzinfo=timezone)
+                            .astimezone(tz.UTC)
+                            .replace(tzinfo=None))
+                    except OverflowError:
+                        pass
+            # The date could be before the product creation
+            valuations = [v for v in valuations
+                if v.product.create_date <= product_context['_datetime']]
+        with Transaction().set_context(product_context):
+            products = Product.browse([v.product.id for v in valuations])
+            for valuation, product in zip(valuations, products):
+                # The product may not have a cost price
+                if product.cost_price is not None:
+                    values[valuation.id] = round_price(
+                        Decimal(str(valuation.quantity or 0))
+                        * product.cost_price)
+        return values
+
+    @fields.depends('product')
+    def on_change_with_unit(self, name=None):
+        return self.product.default_uom if self.product else None
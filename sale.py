@@ -1,6 +1,25 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+
+
+class SaleLine(metaclass=PoolMeta):
+    __name__ = 'sale.line'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # The fields that change the amounts of the valued shipments
+        cls._shipment_valued_fields = {'unit_price', 'taxes'}
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        super().on_modification(mode, lines, field_names=field_names)
+        if mode == 'write' and cls._shipment_valued_fields & field_names:
+            Move._store_shipments_cache(
+                Move._get_origins_valued_shipments(lines))
 
 
 class SaleLineDiscount(metaclass=PoolMeta):
@@ -1,12 +1,30 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
+import json
+import logging
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager
 from decimal import Decimal
-from trytond.model import fields
+from sql import Cast, Literal, Null
+from sql.aggregate import Count, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Position, Substring
+from sql.operators import Concat
+from trytond import backend, config
+from trytond.model import Index, fields
 from trytond.pool import Pool, PoolMeta
-from trytond.modules.account.tax import TaxableMixin
+from trytond.tools import grouped_slice, reduce_ids, sqlite_apply_types
+from trytond.tools.domain_inversion import eval_domain
+from trytond.transaction import Transaction, without_check_access
+from trytond.modules.account.tax import TaxableMixin, _TaxableLine
 from trytond.modules.currency.fields import Monetary
 
-__all__ = ['ShipmentIn', 'ShipmentOut', 'ShipmentOutReturn']
+from .instrument import instrumented
+
+__all__ = ['ShipmentIn', 'ShipmentInReturn', 'ShipmentOut',
+    'ShipmentOutReturn']
 
 MOVES = {
     'stock.shipment.in': 'incoming_moves',
@@ -21,23 +39,69 @@ TAX_TYPE = {
     'stock.shipment.out.return': 'credit_note',
     }
 _ZERO = Decimal(0)
+# The shipments by transaction of which the moves do not store the cache
+_skipped_cache = weakref.WeakKeyDictionary()
+
+logger = logging.getLogger(__name__)
+
+
+def _get_skipped_cache():
+    "Return the model and id of the shipments skipped by the moves"
+    return _skipped_cache.get(Transaction(), set())
+
+
+def _write_rows(rows, file, format='csv'):
+    "Write the rows of dictionaries to the text file as CSV or JSON Lines"
+    if format == 'csv':
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(file, fieldnames=list(row.keys()))
+                writer.writeheader()
+            writer.writerow(row)
+    elif format == 'jsonl':
+        for row in rows:
+            file.write(json.dumps(row, default=str))
+            file.write('\n')
+    else:
+        raise ValueError("Unknown format: %s" % format)
 
 
 class ShipmentValuedMixin(TaxableMixin):
     currency = fields.Function(fields.Many2One('currency.currency',
-        'Currency'), 'on_change_with_currency')
+        'Currency'), 'get_currency')
     untaxed_amount_cache = Monetary('Untaxed Cache',
         digits='currency', currency='currency', readonly=True)
     tax_amount_cache = Monetary('Tax Cache',
         digits='currency', currency='currency', readonly=True)
     total_amount_cache = Monetary('Total Cache',
         digits='currency', currency='currency', readonly=True)
+    amounts_cache_fingerprint = fields.Char('Amounts Cache Fingerprint',
+        readonly=True)
     untaxed_amount = fields.Function(Monetary('Untaxed',
-        digits='currency', currency='currency'), 'get_amounts')
+        digits='currency', currency='currency'), 'get_amounts',
+        searcher='search_untaxed_amount')
     tax_amount = fields.Function(Monetary('Tax',
-        digits='currency', currency='currency'), 'get_amounts')
+        digits='currency', currency='currency'), 'get_amounts',
+        searcher='search_amount')
     total_amount = fields.Function(Monetary('Total',
-        digits='currency', currency='currency'), 'get_amounts')
+        digits='currency', currency='currency'), 'get_amounts',
+        searcher='search_amount')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        for column in [t.untaxed_amount_cache, t.tax_amount_cache,
+                t.total_amount_cache]:
+            cls._sql_indexes.update({
+                    Index(t, (column, Index.Range())),
+                    Index(
+                        t,
+                        (column, Index.Equality(cardinality='low')),
+                        include=[t.id],
+                        where=column == Null),
+                    })
 
     @fields.depends('company')
     def on_change_with_currency(self, name=None):
@@ -50,17 +114,92 @@ class ShipmentValuedMixin(TaxableMixin):
             currency_id = self.company.currency.id
         return currency_id
 
+    @classmethod
+    def get_currency(cls, shipments, name):
+        "Return the currency of the first valued move else of the company"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        currency = Move.__table__()
+
+        move, shipment, from_, where = cls._get_valued_moves_query()
+        currencies = {}
+        for sub_ids in grouped_slice([s.id for s in shipments]):
+            first = from_.select(
+                shipment.id.as_('shipment'), Min(move.id).as_('move'),
+                where=(where & (move.currency != Null)
+                    & reduce_ids(shipment.id, sub_ids)),
+                group_by=shipment.id)
+            cursor.execute(*first.join(currency,
+                    condition=first.move == currency.id
+                    ).select(first.shipment, currency.currency))
+            currencies.update(cursor)
+        for shipment in shipments:
+            if shipment.id not in currencies and shipment.company:
+                currencies[shipment.id] = shipment.company.currency.id
+        return currencies
+
     def get_valued_moves(self):
         Move = Pool().get('stock.move')
+        transaction = Transaction()
 
-        origins = Move._get_origin()
-        keep_origin = True if 'stock.move' in origins else False
-        move_field = MOVES.get(self.__name__)
-        if (keep_origin and self.__name__ == 'stock.shipment.out'):
-            moves = getattr(self, 'outgoing_moves', [])
-            if moves:
+        # The moves are kept until the next modification in the transaction
+        saved = self.id is not None and self.id >= 0
+        if saved:
+            counter, moves = getattr(self, '_valued_moves', (None, None))
+            if counter == transaction.counter:
                 return moves
-        return getattr(self, move_field, [])
+
+        moves = None
+        if Move._origin_move and self.__name__ == 'stock.shipment.out':
+            moves = getattr(self, 'outgoing_moves', [])
+        if not moves:
+            moves = getattr(self, MOVES.get(self.__name__), [])
+        if saved:
+            self._valued_moves = (transaction.counter, moves)
+        return moves
+
+    @classmethod
+    def _get_valued_moves_query(cls):
+        '''
+        Return the move table, the shipment table, the join between them and
+        the condition to select the valued moves that are not cancelled
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        shipment = cls.__table__()
+        from_ = move.join(shipment,
+            condition=move.shipment == Concat(cls.__name__ + ',', shipment.id))
+        return move, shipment, from_, move.state != 'cancelled'
+
+    @classmethod
+    @instrumented
+    def _get_untaxed_amounts(cls, shipments):
+        "Return the sum of the valued move amounts by shipment id"
+        cursor = Transaction().connection.cursor()
+
+        move, shipment, from_, where = cls._get_valued_moves_query()
+        amounts = dict((s.id, Decimal(0)) for s in shipments)
+        # The moves of unsaved shipments are not yet in the database
+        for record in shipments:
+            if record.id is None or record.id < 0:
+                amounts[record.id] = sum((m.amount
+                        for m in record.get_valued_moves()
+                        if m.amount and m.state != 'cancelled'), Decimal(0))
+        shipments = [s for s in shipments if s.id is not None and s.id >= 0]
+        for sub_shipments in grouped_slice(shipments):
+            references = ['%s,%s' % (cls.__name__, s.id)
+                for s in sub_shipments]
+            query = from_.select(shipment.id,
+                Coalesce(Sum(move.amount), 0).as_('amount'),
+                where=where & move.shipment.in_(references),
+                group_by=shipment.id)
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, 'NUMERIC'])
+            cursor.execute(*query)
+            amounts.update(cursor)
+        return amounts
 
     @property
     def tax_type(self):
@@ -70,16 +209,25 @@ class ShipmentValuedMixin(TaxableMixin):
     def taxable_lines(self):
         pool = Pool()
         Move = pool.get('stock.move')
+        moves = self.get_valued_moves()
+        return self._get_taxable_lines(moves, Move._prefetch_origins(moves))
+
+    def _get_taxable_lines(self, moves, origins):
+        "Return the taxable lines of the moves using the origins prefetched"
+        pool = Pool()
+        Move = pool.get('stock.move')
 
         taxable_lines = []
-        for move in self.get_valued_moves():
+        supplier_taxes = {}
+        for move in moves:
             if move.state == 'cancelled':
                 continue
 
-            origin = move.origin
+            origin = origins[move.id] if move.id in origins else move.origin
             if isinstance(origin, Move):
                 unit_price = move.unit_price
-                origin = origin.origin
+                origin = (origins[origin.id] if origin.id in origins
+                    else origin.origin)
                 if origin and hasattr(origin, 'unit_price'):
                     unit_price = origin.unit_price
                 if unit_price is None:
@@ -88,35 +236,132 @@ class ShipmentValuedMixin(TaxableMixin):
                 unit_price = move.unit_price or _ZERO
 
             taxable_lines.append((
-                    getattr(move, 'taxes', None) or [],
+                    move._get_taxes(origins, supplier_taxes),
                     unit_price,
                     getattr(move, 'quantity', None) or 0,
                     None,
                     ))
         return taxable_lines
 
+    @classmethod
+    @instrumented
+    def _get_shipments_taxes(cls, shipments):
+        '''
+        Return the taxes of each shipment like _get_taxes but computing only
+        once the taxes of the lines with the same taxes, unit price, quantity
+        and tax date among all the shipments
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Tax = pool.get('account.tax')
+        Configuration = pool.get('account.configuration')
+        context = Transaction().context
+
+        shipment_moves = {s.id: s.get_valued_moves() for s in shipments}
+        origins = Move._prefetch_origins(
+            [m for moves in shipment_moves.values() for m in moves])
+        computed = {}
+        tax_roundings = {}
+        result = {}
+        for shipment in shipments:
+            tax_context = shipment._get_tax_context()
+            company_id = (shipment.company.id if shipment.company
+                else context.get('company'))
+            shipment_tax_date = shipment.tax_date
+            all_taxes = {}
+            with Transaction().set_context(tax_context):
+                if company_id not in tax_roundings:
+                    config = Configuration(1)
+                    tax_roundings[company_id] = config.get_multivalue(
+                        'tax_rounding', company=company_id)
+                tax_rounding = tax_roundings[company_id]
+                taxable_lines = defaultdict(list)
+                for params in shipment._get_taxable_lines(
+                        shipment_moves[shipment.id], origins):
+                    taxable_line = _TaxableLine(*params)
+                    taxable_lines[taxable_line._key].append(taxable_line)
+                for grouped_taxable_lines in taxable_lines.values():
+                    taxes = {}
+                    for line in grouped_taxable_lines:
+                        tax_date = line.tax_date or shipment_tax_date
+                        key = (tuple(t.id for t in line.taxes),
+                            line.unit_price, line.quantity, tax_date,
+                            tuple(sorted(tax_context.items())))
+                        if key not in computed:
+                            computed[key] = Tax.compute(
+                                Tax.browse(line.taxes), line.unit_price,
+                                line.quantity, tax_date)
+                        current_taxes = {}
+                        for tax in computed[key]:
+                            taxline = shipment._compute_tax_line(**tax)
+                            if taxline._key not in current_taxes:
+                                current_taxes[taxline._key] = taxline
+                            else:
+                                current_taxes[taxline._key] += taxline
+                        if tax_rounding == 'line':
+                            shipment._round_taxes(current_taxes)
+                        for tax_key, taxline in current_taxes.items():
+                            if tax_key not in taxes:
+                                taxes[tax_key] = taxline
+                            else:
+                                taxes[tax_key] += taxline
+                    if tax_rounding == 'document':
+                        shipment._round_taxes(taxes)
+                    for tax_key, taxline in taxes.items():
+                        if tax_key not in all_taxes:
+                            all_taxes[tax_key] = taxline
+                        else:
+                            all_taxes[tax_key] += taxline
+            result[shipment.id] = all_taxes
+        return result
+
     def compute_amounts(self):
-        untaxed_amount = sum((m.amount for m in self.get_valued_moves()
-            if m.amount and m.state != 'cancelled'), Decimal(0))
-        taxes = self._get_taxes()
-        untaxed_amount = self.company.currency.round(untaxed_amount)
-        tax_amount = sum((self.company.currency.round(tax.amount)
-                for tax in taxes.values()), Decimal(0))
+        amounts = self._compute_amounts([self])
+        return {n: a[self.id] for n, a in amounts.items()}
+
+    @classmethod
+    def _compute_amounts(cls, shipments):
+        "Return the amounts of shipments by name and id without cache"
+        untaxed_amounts = dict((i.id, Decimal(0)) for i in shipments)
+        tax_amounts = dict((i.id, Decimal(0)) for i in shipments)
+        total_amounts = dict((i.id, Decimal(0)) for i in shipments)
+
+        move_amounts = cls._get_untaxed_amounts(shipments)
+        shipments_taxes = cls._get_shipments_taxes([s
+                for s in shipments if move_amounts[s.id]])
+        for shipment in shipments:
+            untaxed_amount = shipment.company.currency.round(
+                move_amounts[shipment.id])
+            if untaxed_amount:
+                taxes = shipments_taxes[shipment.id]
+                tax_amount = sum((shipment.company.currency.round(tax.amount)
+                        for tax in taxes.values()), Decimal(0))
+                total_amount = untaxed_amount + tax_amount
+            else:
+                tax_amount = Decimal(0)
+                total_amount = Decimal(0)
+            untaxed_amounts[shipment.id] = untaxed_amount
+            tax_amounts[shipment.id] = tax_amount
+            total_amounts[shipment.id] = total_amount
         return {
-            'untaxed_amount': untaxed_amount,
-            'tax_amount': tax_amount if untaxed_amount else Decimal(0),
-            'total_amount': (untaxed_amount + tax_amount
-                if untaxed_amount else Decimal(0)),
+            'untaxed_amount': untaxed_amounts,
+            'tax_amount': tax_amounts,
+            'total_amount': total_amounts,
             }
 
     @classmethod
+    @instrumented
     def get_amounts(cls, shipments, names):
         untaxed_amounts = dict((i.id, Decimal(0)) for i in shipments)
         tax_amounts = dict((i.id, Decimal(0)) for i in shipments)
         total_amounts = dict((i.id, Decimal(0)) for i in shipments)
 
+        stale = cls._get_stale_cache([s.id for s in shipments
+                if s.state in cls._states_valued_cached])
+        shipments_no_cache = []
         for shipment in shipments:
             if (shipment.state in cls._states_valued_cached
+                    and shipment.id not in stale
                     and shipment.untaxed_amount_cache is not None
                     and shipment.tax_amount_cache is not None
                     and shipment.total_amount_cache is not None):
@@ -125,20 +370,12 @@ class ShipmentValuedMixin(TaxableMixin):
                 tax_amounts[shipment.id] = shipment.tax_amount_cache
                 total_amounts[shipment.id] = shipment.total_amount_cache
             else:
-                untaxed_amount = sum((m.amount for m in shipment.get_valued_moves()
-                    if m.amount and m.state != 'cancelled'), Decimal(0))
-                taxes = shipment._get_taxes()
-                untaxed_amount = shipment.company.currency.round(untaxed_amount)
-                if untaxed_amount:
-                    tax_amount = sum((shipment.company.currency.round(tax.amount)
-                            for tax in taxes.values()), Decimal(0))
-                    total_amount = untaxed_amount + tax_amount
-                else:
-                    tax_amount = Decimal(0)
-                    total_amount = Decimal(0)
-                untaxed_amounts[shipment.id] = untaxed_amount
-                tax_amounts[shipment.id] = tax_amount
-                total_amounts[shipment.id] = total_amount
+                shipments_no_cache.append(shipment)
+
+        amounts = cls._compute_amounts(shipments_no_cache)
+        untaxed_amounts.update(amounts['untaxed_amount'])
+        tax_amounts.update(amounts['tax_amount'])
+        total_amounts.update(amounts['total_amount'])
         result = {
             'untaxed_amount': untaxed_amounts,
             'tax_amount': tax_amounts,
@@ -150,20 +387,364 @@ class ShipmentValuedMixin(TaxableMixin):
         return result
 
     @classmethod
+    def search_untaxed_amount(cls, name, clause):
+        table = cls.__table__()
+        type_name = cls.untaxed_amount._field.sql_type().base
+        move, shipment, from_, where = cls._get_valued_moves_query()
+        invalid = cls._get_cache_invalid(table)
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        # SQLite uses float for sum
+        if value is not None and backend.name == 'sqlite':
+            value = float(value)
+
+        amount = from_.select(Coalesce(Sum(move.amount), 0).cast(type_name),
+            where=where & (shipment.id == table.id))
+        query = table.select(table.id,
+            where=invalid & Operator(amount, value))
+        query |= table.select(table.id,
+            where=~invalid & Operator(
+                table.untaxed_amount_cache.cast(type_name), value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def search_amount(cls, name, clause):
+        '''
+        Search on the tax or total amount. The shipments with valued moves
+        but without valid cache are computed with Python by chunks, so the
+        search is as slow as the number of those shipments which must be kept
+        low by storing the cache (see rebuild_cache).
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        type_name = getattr(cls, name)._field.sql_type().base
+        column = getattr(table, name + '_cache')
+        move, shipment, from_, where = cls._get_valued_moves_query()
+        invalid = cls._get_cache_invalid(table)
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        if value is not None and backend.name == 'sqlite':
+            value = float(value)
+
+        query = table.select(table.id,
+            where=~invalid & Operator(column.cast(type_name), value))
+        # The amounts of the shipments without valued moves are zero
+        valued = from_.select(shipment.id, where=where)
+        if eval_domain([clause], {name: _ZERO}):
+            query |= table.select(table.id,
+                where=invalid & ~table.id.in_(valued))
+        # Taxes can not be computed with SQL so only the shipments with
+        # valued moves and without valid cache are evaluated with Python
+        cursor.execute(*table.select(table.id,
+                where=invalid & table.id.in_(valued)))
+        ids = []
+        for sub_ids in grouped_slice([i for i, in cursor]):
+            amounts = cls._compute_amounts(cls.browse(sub_ids))[name]
+            ids.extend(i for i, a in amounts.items()
+                if eval_domain([clause], {name: a}))
+        return ['OR',
+            ('id', 'in', query),
+            ('id', 'in', ids),
+            ]
+
+    @classmethod
+    def _order_amount(cls, table, column):
+        move, shipment, from_, where = cls._get_valued_moves_query()
+        # The taxes can not be computed with SQL so the shipments without
+        # valid cache are ordered by the untaxed amount of their moves
+        amount = from_.select(Sum(move.amount),
+            where=where & (shipment.id == table.id))
+        return [Case((cls._get_cache_invalid(table), amount), else_=column)]
+
+    @classmethod
+    def order_untaxed_amount(cls, tables):
+        table, _ = tables[None]
+        return cls._order_amount(table, table.untaxed_amount_cache)
+
+    @classmethod
+    def order_tax_amount(cls, tables):
+        table, _ = tables[None]
+        return cls._order_amount(table, table.tax_amount_cache)
+
+    @classmethod
+    def order_total_amount(cls, tables):
+        table, _ = tables[None]
+        return cls._order_amount(table, table.total_amount_cache)
+
+    @classmethod
+    def _get_cache_fingerprint(cls, table):
+        '''
+        Return the SQL expression of the fingerprint of the valued moves of
+        the shipment table. It changes only with the values of the moves that
+        the amounts depend on: their number, their amounts and a checksum of
+        their quantity, unit price, product and origin id from which the
+        taxes come.
+        '''
+        move, shipment, from_, where = cls._get_valued_moves_query()
+        values = [
+            Count(Literal('*')),
+            Sum(move.amount),
+            # The sum of floats depends on the order of the rows
+            Sum(move.id * Cast(move.quantity, 'NUMERIC')),
+            Sum(move.id * move.unit_price),
+            Sum(move.id * move.product),
+            Sum(move.id * Cast(Substring(move.origin,
+                        Position(',', move.origin) + 1), 'INTEGER')),
+            ]
+        fingerprint = None
+        for value in values:
+            value = Coalesce(Cast(value, 'VARCHAR'), '')
+            if fingerprint is None:
+                fingerprint = value
+            else:
+                fingerprint = Concat(Concat(fingerprint, ':'), value)
+        return from_.select(fingerprint,
+            where=where & (shipment.id == table.id))
+
+    @classmethod
+    @instrumented
+    def _get_stale_cache(cls, ids):
+        "Return the ids of which amounts cache does not match the moves"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        fingerprint = table.amounts_cache_fingerprint
+
+        stale = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & ((fingerprint == Null)
+                        | (fingerprint != cls._get_cache_fingerprint(table)))))
+            stale.update(i for i, in cursor)
+        return stale
+
+    @classmethod
+    @instrumented
+    def _write_cache(cls, ids, untaxed_amount, tax_amount, total_amount):
+        "Write the amounts cache of the ids with SQL"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        # The fingerprint is computed by the database from the current moves
+        if untaxed_amount is not None:
+            fingerprint = cls._get_cache_fingerprint(table)
+        else:
+            fingerprint = None
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                    [table.untaxed_amount_cache, table.tax_amount_cache,
+                        table.total_amount_cache,
+                        table.amounts_cache_fingerprint],
+                    [untaxed_amount, tax_amount, total_amount, fingerprint],
+                    where=reduce_ids(table.id, sub_ids)))
+
+        # Clean the caches like ModelStorage.write does
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                cache_cls = cache[cls.__name__]
+                for id_ in ids:
+                    cache_cls.pop(id_, None)
+
+    @classmethod
+    @instrumented
     def store_cache(cls, shipments):
+        shipments = list(shipments)
+        amounts = cls._compute_amounts(shipments)
+        # Write together the shipments with the same amounts
+        to_write = defaultdict(list)
         for shipment in shipments:
-            shipment.untaxed_amount_cache = shipment.untaxed_amount
-            shipment.tax_amount_cache = shipment.tax_amount
-            shipment.total_amount_cache = shipment.total_amount
-        cls.save(shipments)
+            key = (amounts['untaxed_amount'][shipment.id],
+                amounts['tax_amount'][shipment.id],
+                amounts['total_amount'][shipment.id])
+            to_write[key].append(shipment.id)
+        for key, ids in to_write.items():
+            cls._write_cache(ids, *key)
+
+    @classmethod
+    @contextmanager
+    def _skip_moves_cache(cls, shipments):
+        '''
+        Skip the store of the cache of the shipments by their moves while the
+        shipments store it themselves after
+        '''
+        skipped = _skipped_cache.setdefault(Transaction(), set())
+        keys = {(cls.__name__, s.id) for s in shipments} - skipped
+        skipped |= keys
+        try:
+            yield
+        finally:
+            skipped -= keys
 
     @classmethod
     def reset_cache(cls, shipments):
-        for shipment in shipments:
-            shipment.untaxed_amount_cache = None
-            shipment.tax_amount_cache = None
-            shipment.total_amount_cache = None
-        cls.save(shipments)
+        cls._write_cache([s.id for s in shipments], None, None, None)
+
+    @classmethod
+    def _get_cache_invalid(cls, table):
+        "Return the SQL condition of the shipments with missing or stale cache"
+        return ((table.untaxed_amount_cache == Null)
+            | (table.tax_amount_cache == Null)
+            | (table.total_amount_cache == Null)
+            | (table.amounts_cache_fingerprint == Null)
+            | (table.amounts_cache_fingerprint
+                != cls._get_cache_fingerprint(table)))
+
+    @classmethod
+    def _store_valuation(cls, shipments):
+        "Store the amounts cache and refresh the valuation of the shipments"
+        pool = Pool()
+        Valuation = pool.get('stock.shipment.valuation')
+        cls.store_cache(shipments)
+        Valuation.refresh(shipments)
+
+    @classmethod
+    def _queue_context(cls):
+        "Return the context to enqueue the tasks of the amounts cache"
+        transaction = Transaction()
+        queue_batch = config.getint(
+            'stock_valued', 'queue_batch', default=None) or True
+        return transaction.set_context(
+            queue_batch=transaction.context.get('queue_batch', queue_batch))
+
+    @classmethod
+    def _update_cache(cls, shipments):
+        '''
+        Store the amounts cache of the shipments. When the queue_cache option
+        is set, the cache is reset and stored by queued tasks after the
+        commit.
+        '''
+        if config.getboolean('stock_valued', 'queue_cache', default=False):
+            cls.reset_cache(shipments)
+            with cls._queue_context():
+                cls.__queue__.store_cache(shipments)
+        else:
+            cls.store_cache(shipments)
+
+    @classmethod
+    def _update_valuation(cls, shipments):
+        '''
+        Store the amounts cache and refresh the valuation of the shipments.
+        When the queue_cache option is set, the cache is reset and stored by
+        queued tasks after the commit, the amounts are computed on the fly
+        until then.
+        '''
+        if config.getboolean('stock_valued', 'queue_cache', default=False):
+            cls.reset_cache(shipments)
+            with cls._queue_context():
+                cls.__queue__._store_valuation(shipments)
+        else:
+            cls._store_valuation(shipments)
+
+    @classmethod
+    def _get_valuation_columns(cls, table):
+        '''
+        Return the join from the shipment table to value and the columns of
+        the warehouse and the party
+        '''
+        if 'customer' in cls._fields:
+            party = table.customer
+        else:
+            party = table.supplier
+        return table, table.warehouse, party
+
+    @classmethod
+    def _get_pending_cache_ids(cls):
+        "Return the ids of which amounts cache is stored by a pending task"
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        methods = {'store_cache', '_store_valuation'}
+
+        ids = set()
+        with without_check_access():
+            tasks = Queue.search([('finished_at', '=', None)])
+        for task in tasks:
+            data = task.data or {}
+            if (data.get('model') == cls.__name__
+                    and data.get('method') in methods):
+                instances = data.get('instances')
+                if isinstance(instances, int):
+                    ids.add(instances)
+                elif instances:
+                    ids.update(instances)
+        return ids
+
+    @classmethod
+    def rebuild_cache(cls):
+        "Enqueue by chunks the store of the missing or stale amounts cache"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        chunk = config.getint('stock_valued', 'cache_chunk', default=1000)
+
+        where = cls._get_cache_invalid(table)
+        pending = cls._get_pending_cache_ids()
+
+        # Each chunk is stored in its own task so an interrupted rebuild
+        # continues with the shipments still without cache
+        count, last_id = 0, 0
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=where & (table.id > last_id),
+                    order_by=table.id.asc,
+                    limit=chunk))
+            ids = [i for i, in cursor]
+            if not ids:
+                break
+            last_id = ids[-1]
+            ids = [i for i in ids if i not in pending]
+            if ids:
+                cls.__queue__.store_cache(cls.browse(ids))
+                count += len(ids)
+                logger.info(
+                    "Rebuild amounts cache of %s: %s enqueued up to id %s",
+                    cls.__name__, count, last_id)
+
+    @classmethod
+    def get_valuation_rows(cls, domain=None, chunk=None):
+        '''
+        Yield the valuation of the shipments matching domain as dictionaries.
+        The shipments are read by chunks of ids and their amounts are taken
+        from the cache when valid or computed by chunk otherwise.
+        '''
+        if chunk is None:
+            chunk = config.getint('stock_valued', 'export_chunk', default=1000)
+        names = ['untaxed_amount', 'tax_amount', 'total_amount']
+
+        last_id = 0
+        while True:
+            shipments = cls.search([
+                    domain or [],
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=chunk)
+            if not shipments:
+                break
+            amounts = cls.get_amounts(shipments, names)
+            for shipment in shipments:
+                party = (getattr(shipment, 'customer', None)
+                    or getattr(shipment, 'supplier', None))
+                row = {
+                    'id': shipment.id,
+                    'model': cls.__name__,
+                    'number': shipment.number,
+                    'state': shipment.state,
+                    'party': party.id if party else None,
+                    'planned_date': shipment.planned_date,
+                    'effective_date': shipment.effective_date,
+                    'currency': (
+                        shipment.currency.code if shipment.currency else None),
+                    }
+                for name in names:
+                    row[name] = amounts[name][shipment.id]
+                yield row
+            last_id = shipments[-1].id
+
+    @classmethod
+    def export_valuation(cls, file, format='csv', domain=None, chunk=None):
+        "Write the valuation of the shipments to the text file"
+        _write_rows(cls.get_valuation_rows(domain, chunk), file, format)
 
 
 class ShipmentIn(ShipmentValuedMixin, metaclass=PoolMeta):
@@ -173,7 +754,7 @@ class ShipmentIn(ShipmentValuedMixin, metaclass=PoolMeta):
     def __setup__(cls):
         super(ShipmentIn, cls).__setup__()
         # The states where amounts are cached
-        cls._states_valued_cached = ['done', 'cancelled']
+        cls._states_valued_cached = [s for s, _ in cls.state.selection]
 
     @classmethod
     def __register__(cls, module_name):
@@ -186,15 +767,63 @@ class ShipmentIn(ShipmentValuedMixin, metaclass=PoolMeta):
 
         super(ShipmentIn, cls).__register__(module_name)
 
+    @classmethod
+    def _get_valued_moves_query(cls):
+        move, shipment, from_, where = super(ShipmentIn,
+            cls)._get_valued_moves_query()
+        # Same moves than get_incoming_moves
+        where &= ((shipment.warehouse_input == shipment.warehouse_storage)
+            | (move.to_location == shipment.warehouse_input))
+        return move, shipment, from_, where
+
     @classmethod
     def cancel(cls, shipments):
-        super(ShipmentIn, cls).cancel(shipments)
-        cls.store_cache(shipments)
+        with cls._skip_moves_cache(shipments):
+            super(ShipmentIn, cls).cancel(shipments)
+        cls._update_valuation(shipments)
 
     @classmethod
     def do(cls, shipments):
-        super(ShipmentIn, cls).do(shipments)
-        cls.store_cache(shipments)
+        with cls._skip_moves_cache(shipments):
+            super(ShipmentIn, cls).do(shipments)
+        cls._update_valuation(shipments)
+
+
+class ShipmentInReturn(ShipmentValuedMixin, metaclass=PoolMeta):
+    __name__ = 'stock.shipment.in.return'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # The states where amounts are cached
+        cls._states_valued_cached = [s for s, _ in cls.state.selection]
+
+    @classmethod
+    def _get_valuation_columns(cls, table):
+        pool = Pool()
+        Location = pool.get('stock.location')
+        location = Location.__table__()
+        warehouse = Location.__table__()
+        # The warehouse is the one of the from location
+        from_ = (table
+            .join(location, condition=table.from_location == location.id)
+            .join(warehouse, 'LEFT',
+                condition=(warehouse.type == 'warehouse')
+                & (warehouse.left <= location.left)
+                & (warehouse.right >= location.right)))
+        return from_, warehouse.id, table.supplier
+
+    @classmethod
+    def cancel(cls, shipments):
+        with cls._skip_moves_cache(shipments):
+            super().cancel(shipments)
+        cls._update_valuation(shipments)
+
+    @classmethod
+    def do(cls, shipments):
+        with cls._skip_moves_cache(shipments):
+            super().do(shipments)
+        cls._update_valuation(shipments)
 
 
 class ShipmentOut(ShipmentValuedMixin, metaclass=PoolMeta):
@@ -204,7 +833,7 @@ class ShipmentOut(ShipmentValuedMixin, metaclass=PoolMeta):
     def __setup__(cls):
         super(ShipmentOut, cls).__setup__()
         # The states where amounts are cached
-        cls._states_valued_cached = ['done', 'cancelled']
+        cls._states_valued_cached = [s for s, _ in cls.state.selection]
 
     @classmethod
     def __register__(cls, module_name):
@@ -217,15 +846,26 @@ class ShipmentOut(ShipmentValuedMixin, metaclass=PoolMeta):
 
         super(ShipmentOut, cls).__register__(module_name)
 
+    @classmethod
+    def _get_valued_moves_query(cls):
+        move, shipment, from_, where = super(ShipmentOut,
+            cls)._get_valued_moves_query()
+        # Same moves than get_outgoing_moves
+        where &= ((shipment.warehouse_output == shipment.warehouse_storage)
+            | (move.from_location == shipment.warehouse_output))
+        return move, shipment, from_, where
+
     @classmethod
     def cancel(cls, shipments):
-        super(ShipmentOut, cls).cancel(shipments)
-        cls.store_cache(shipments)
+        with cls._skip_moves_cache(shipments):
+            super(ShipmentOut, cls).cancel(shipments)
+        cls._update_valuation(shipments)
 
     @classmethod
     def do(cls, shipments):
-        super(ShipmentOut, cls).do(shipments)
-        cls.store_cache(shipments)
+        with cls._skip_moves_cache(shipments):
+            super(ShipmentOut, cls).do(shipments)
+        cls._update_valuation(shipments)
 
 
 class ShipmentOutReturn(ShipmentValuedMixin, metaclass=PoolMeta):
@@ -235,14 +875,25 @@ class ShipmentOutReturn(ShipmentValuedMixin, metaclass=PoolMeta):
     def __setup__(cls):
         super(ShipmentOutReturn, cls).__setup__()
         # The states where amounts are cached
-        cls._states_valued_cached = ['done', 'cancelled']
+        cls._states_valued_cached = [s for s, _ in cls.state.selection]
+
+    @classmethod
+    def _get_valued_moves_query(cls):
+        move, shipment, from_, where = super(ShipmentOutReturn,
+            cls)._get_valued_moves_query()
+        # Same moves than get_incoming_moves
+        where &= ((shipment.warehouse_input == shipment.warehouse_storage)
+            | (move.to_location == shipment.warehouse_input))
+        return move, shipment, from_, where
 
     @classmethod
     def cancel(cls, shipments):
-        super(ShipmentOutReturn, cls).cancel(shipments)
-        cls.store_cache(shipments)
+        with cls._skip_moves_cache(shipments):
+            super(ShipmentOutReturn, cls).cancel(shipments)
+        cls._update_valuation(shipments)
 
     @classmethod
     def do(cls, shipments):
-        super(ShipmentOutReturn, cls).do(shipments)
-        cls.store_cache(shipments)
+        with cls._skip_moves_cache(shipments):
+            super(ShipmentOutReturn, cls).do(shipments)
+        cls._update_valuation(shipments)
@@ -0,0 +1,229 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark of the valuation of the shipments and moves.
+
+It creates a database with synthetic supplier shipments and reports the time,
+the number of SQL queries and the peak of memory of each valuation path.
+The database backend is selected like for the tests with the DB_NAME and
+TRYTOND_DATABASE_URI environment variables, for example:
+
+    DB_NAME=:memory: python -m trytond.modules.stock_valued.tests.benchmark
+"""
+import argparse
+import logging
+import time
+import tracemalloc
+from decimal import Decimal
+
+from proteus import Model, config as pconfig
+from trytond.modules.account.tests.tools import (
+    create_chart, create_tax, get_accounts)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+
+class QueryCounter(logging.Handler):
+    "Count the queries logged by the database backends"
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def setup(args):
+    activate_modules(['stock_valued'])
+
+    _ = create_company()
+    company = get_company()
+    _ = create_chart(company)
+    accounts = get_accounts(company)
+
+    Party = Model.get('party.party')
+    supplier = Party(name="Supplier")
+    supplier.save()
+
+    ProductUom = Model.get('product.uom')
+    ProductCategory = Model.get('product.category')
+    ProductTemplate = Model.get('product.template')
+    unit, = ProductUom.find([('name', '=', "Unit")])
+    products = []
+    for i in range(args.taxes):
+        tax = create_tax(Decimal(i + 1) / 100)
+        tax.save()
+        category = ProductCategory(name="Category %s" % i)
+        category.accounting = True
+        category.account_expense = accounts['expense']
+        category.account_revenue = accounts['revenue']
+        category.supplier_taxes.append(tax)
+        category.save()
+        template = ProductTemplate(name="Product %s" % i)
+        template.default_uom = unit
+        template.type = 'goods'
+        template.list_price = Decimal('10')
+        template.account_category = category
+        template.save()
+        product, = template.products
+        products.append(product.id)
+    return supplier.id, unit.id, products
+
+
+def create_shipments(args, supplier, unit, products):
+    cfg = pconfig.get_config()
+    pool = Pool(cfg.database_name)
+    with Transaction().start(
+            cfg.database_name, cfg.user, context=cfg.context):
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.in')
+        Company = pool.get('company.company')
+
+        company = Company(cfg.context['company'])
+        supplier_location, = Location.search([('type', '=', 'supplier')])
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        shipments = Shipment.create([{
+                    'supplier': supplier,
+                    'warehouse': warehouse.id,
+                    'warehouse_input': warehouse.input_location.id,
+                    'warehouse_storage': warehouse.storage_location.id,
+                    'company': company.id,
+                    } for _ in range(args.shipments)])
+
+        def values(i, unit_price):
+            values = {
+                'product': products[i % len(products)],
+                'unit': unit,
+                'quantity': i % 10 + 1,
+                'from_location': supplier_location.id,
+                'to_location': warehouse.input_location.id,
+                'company': company.id,
+                'currency': company.currency.id,
+                'unit_price': unit_price,
+                }
+            if args.discount:
+                values['base_price'] = unit_price + Decimal(i % 5)
+            return values
+
+        vlist = []
+        for shipment in shipments:
+            origins = [None] * args.moves
+            if args.origin:
+                origins = Move.create([values(i, Decimal(i % 50 + 1))
+                        for i in range(args.moves)])
+            for i, origin in enumerate(origins):
+                value = values(i, Decimal(i % 50 + 1))
+                value['shipment'] = str(shipment)
+                if origin:
+                    value['origin'] = str(origin)
+                vlist.append(value)
+        Move.create(vlist)
+
+
+def benchmark(args):
+    cfg = pconfig.get_config()
+    pool = Pool(cfg.database_name)
+    counter = QueryCounter()
+    names = ['untaxed_amount', 'tax_amount', 'total_amount']
+
+    def measure(name, func):
+        with Transaction().start(
+                cfg.database_name, cfg.user, context=cfg.context):
+            counter.count = 0
+            tracemalloc.start()
+            start = time.perf_counter()
+            count = func()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print("%-30s %8s %10.3fs %8s queries %10.1f KiB" % (
+                name, count, elapsed, counter.count, peak / 1024))
+
+    def get_amounts():
+        Shipment = pool.get('stock.shipment.in')
+        shipments = Shipment.search([])
+        Shipment.get_amounts(shipments, names)
+        return len(shipments)
+
+    def store_cache():
+        Shipment = pool.get('stock.shipment.in')
+        shipments = Shipment.search([])
+        Shipment.store_cache(shipments)
+        return len(shipments)
+
+    def reset_cache():
+        Shipment = pool.get('stock.shipment.in')
+        shipments = Shipment.search([])
+        Shipment.reset_cache(shipments)
+        return len(shipments)
+
+    def get_taxes():
+        Move = pool.get('stock.move')
+        moves = Move.search([('shipment', '!=', None)])
+        Move.get_taxes(moves, 'taxes')
+        return len(moves)
+
+    def get_discounts():
+        Move = pool.get('stock.move')
+        moves = Move.search([('shipment', '!=', None)])
+        Move.get_discounts(moves, ['discount_rate', 'discount'])
+        return len(moves)
+
+    logger = logging.getLogger('trytond.backend')
+    logger.addHandler(counter)
+    try:
+        # The moves store the cache when they are created
+        with Transaction().start(
+                cfg.database_name, cfg.user,
+                context=cfg.context) as transaction:
+            reset_cache()
+            transaction.commit()
+        measure("get_amounts (no cache)", get_amounts)
+        measure("store_cache", store_cache)
+        measure("get_amounts (cache)", get_amounts)
+        measure("reset_cache", reset_cache)
+        measure("Move.get_taxes", get_taxes)
+        measure("Move.get_discounts", get_discounts)
+    finally:
+        logger.removeHandler(counter)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shipments', type=int, default=100,
+        help="the number of supplier shipments")
+    parser.add_argument('--moves', type=int, default=20,
+        help="the number of moves per shipment")
+    parser.add_argument('--taxes', type=int, default=3,
+        help="the number of products each with a different tax")
+    parser.add_argument('--origin', action='store_true',
+        help="set a stock move as origin of the shipment moves")
+    parser.add_argument('--discount', action='store_true',
+        help="set a base price on the moves")
+    args = parser.parse_args()
+
+    # The queries are only logged by SQLite when debug is enabled before
+    # connecting
+    logger = logging.getLogger('trytond.backend')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    drop_db()
+    try:
+        start = time.perf_counter()
+        supplier, unit, products = setup(args)
+        create_shipments(args, supplier, unit, products)
+        print("Setup %s shipments of %s moves: %.3fs" % (
+                args.shipments, args.moves, time.perf_counter() - start))
+        benchmark(args)
+    finally:
+        drop_db()
+
+
+if __name__ == '__main__':
+    main()
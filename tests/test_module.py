@@ -1,8 +1,10 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from unittest.mock import patch
 
 from trytond.modules.company.tests import CompanyTestMixin
+from trytond.modules.stock_valued import instrument
 from trytond.tests.test_tryton import ModuleTestCase
 
 
@@ -10,5 +12,44 @@ class StockValuedTestCase(CompanyTestMixin, ModuleTestCase):
     'Test StockValued module'
     module = 'stock_valued'
 
+    def test_instrument_disabled(self):
+        "Test instrumented method when disabled"
+        def compute(cls, records):
+            pass
+
+        with patch.object(instrument, 'ENABLED', False):
+            self.assertIs(instrument.instrumented(compute), compute)
+
+    def test_instrument_stats(self):
+        "Test statistics of instrumented method"
+        class Shipment:
+            pass
+
+        def compute(cls, records):
+            return len(records)
+
+        with patch.object(instrument, 'ENABLED', True):
+            compute = instrument.instrumented(compute)
+        instrument.reset_stats()
+        self.addCleanup(instrument.reset_stats)
+
+        self.assertEqual(compute(Shipment, [1, 2, 3]), 3)
+        self.assertEqual(compute(Shipment, (4,)), 1)
+        stats = instrument.get_stats()
+
+        self.assertEqual(list(stats), ['Shipment.compute'])
+        stat = stats['Shipment.compute']
+        self.assertEqual(stat['calls'], 2)
+        self.assertEqual(stat['records'], 4)
+        self.assertEqual(stat['queries'], 0)
+        self.assertGreaterEqual(stat['time'], stat['max_time'])
+
+        stat['calls'] = 0
+        stats = instrument.get_stats()
+        self.assertEqual(stats['Shipment.compute']['calls'], 2)
+
+        instrument.reset_stats()
+        self.assertEqual(instrument.get_stats(), {})
+
 
 del ModuleTestCase
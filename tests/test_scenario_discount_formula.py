@@ -1,5 +1,6 @@
 import unittest
 from decimal import Decimal
+from unittest.mock import patch
 
 from proteus import Model
 from trytond.modules.account.tests.tools import (create_chart,
@@ -8,8 +9,12 @@ from trytond.modules.account.tests.tools import (create_chart,
 from trytond.modules.account_invoice.tests.tools import (
     create_payment_term, set_fiscalyear_invoice_sequences)
 from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.discount_formula.discount import DiscountMixin
+from trytond.modules.stock_valued import move as move_module
+from trytond.pool import Pool
 from trytond.tests.test_tryton import drop_db
 from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
 
 
 class Test(unittest.TestCase):
@@ -25,7 +30,7 @@ class Test(unittest.TestCase):
     def test(self):
 
         # Install stock_value, sale and purchase Modules
-        activate_modules(['stock_valued', 'discount_formula',
+        config = activate_modules(['stock_valued', 'discount_formula',
             'sale_discount', 'purchase_discount'])
 
         # Create company
@@ -219,3 +224,48 @@ class Test(unittest.TestCase):
         self.assertEqual(move.discount_rate, Decimal('0.1000'))
         self.assertEqual(move.discount, '10%')
         self.assertEqual(len(move.taxes), 1)
+
+        # The moves with the same formula evaluate it once
+        with Transaction().start(config.database_name, 0,
+                context={'company': company.id}):
+            Move = Pool().get('stock.move')
+            move_module._formula_cache.clear()
+            evaluations = []
+            on_change = DiscountMixin.on_change_discount_formula
+
+            def counted_on_change(self):
+                evaluations.append(self.discount_formula)
+                return on_change(self)
+
+            with patch.object(DiscountMixin, 'on_change_discount_formula',
+                    counted_on_change):
+                moves = Move.create([{
+                            'product': product.id,
+                            'unit': unit.id,
+                            'quantity': quantity,
+                            'from_location': supplier_loc.id,
+                            'to_location': (
+                                shipment.warehouse.input_location.id),
+                            'company': company.id,
+                            'currency': company.currency.id,
+                            'base_price': Decimal('5'),
+                            'discount_formula': '10*9+10+0.35/',
+                            } for quantity in [1, 2, 3]])
+                move = Move(
+                    quantity=4, base_price=Decimal('5'),
+                    currency=company.currency.id,
+                    discount_formula='10*9+10+0.35/')
+                move.on_change_discount_formula()
+            self.assertEqual(len(evaluations), 1)
+            self.assertEqual(
+                [m.unit_price for m in moves], [Decimal('3.7000')] * 3)
+            self.assertEqual(
+                [m.amount for m in moves],
+                [Decimal('3.70'), Decimal('7.40'), Decimal('11.10')])
+            self.assertEqual(move.unit_price, Decimal('3.7000'))
+            self.assertEqual(move.discount_rate, Decimal('0.2600'))
+            self.assertEqual(move.amount, Decimal('14.80'))
+            self.assertEqual(len(move_module._formula_cache), 1)
+            (database_name, formula), = move_module._formula_cache
+            self.assertEqual(database_name, config.database_name)
+            self.assertEqual(formula, '10*9+10+0.35/')
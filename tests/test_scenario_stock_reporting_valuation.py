@@ -0,0 +1,87 @@
+import datetime
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        today = datetime.date.today()
+
+        # Install stock_valued Module
+        config = activate_modules('stock_valued')
+
+        # Create company
+        _ = create_company()
+        company = get_company()
+
+        # Create product at average cost
+        ProductUom = Model.get('product.uom')
+        unit, = ProductUom.find([('name', '=', 'Unit')])
+        ProductTemplate = Model.get('product.template')
+        template = ProductTemplate()
+        template.name = 'product'
+        template.default_uom = unit
+        template.type = 'goods'
+        template.list_price = Decimal('10')
+        template.cost_price_method = 'average'
+        template.save()
+        product, = template.products
+
+        # Get stock locations
+        Location = Model.get('stock.location')
+        warehouse, = Location.find([('type', '=', 'warehouse')])
+        supplier_loc, = Location.find([('code', '=', 'SUP')])
+        customer_loc, = Location.find([('code', '=', 'CUS')])
+        storage_loc = warehouse.storage_location
+
+        # Receive 10 units at 1 and 10 units at 3 and ship 5 units
+        Move = Model.get('stock.move')
+
+        def do_move(from_location, to_location, quantity, unit_price):
+            move = Move()
+            move.product = product
+            move.unit = unit
+            move.quantity = quantity
+            move.from_location = from_location
+            move.to_location = to_location
+            move.company = company
+            move.unit_price = unit_price
+            move.currency = company.currency
+            move.effective_date = today
+            move.click('do')
+            self.assertEqual(move.state, 'done')
+
+        Valuation = Model.get('stock.reporting.valuation')
+
+        def valuation():
+            with config.set_context(
+                    company=company.id, location=warehouse.id, date=today):
+                valuation, = Valuation.find([])
+            return valuation.quantity, valuation.value
+
+        do_move(supplier_loc, storage_loc, 10, Decimal('1'))
+        self.assertEqual(valuation(), (10, Decimal('10.0000')))
+
+        do_move(supplier_loc, storage_loc, 10, Decimal('3'))
+        product.reload()
+        self.assertEqual(product.cost_price, Decimal('2.0000'))
+        # The stock is valued at the cost price of the product
+        self.assertEqual(valuation(), (20, Decimal('40.0000')))
+
+        do_move(storage_loc, customer_loc, 5, Decimal('10'))
+        self.assertEqual(valuation(), (15, Decimal('30.0000')))
@@ -1,5 +1,10 @@
+import csv
+import datetime
+import io
+import json
 import unittest
 from decimal import Decimal
+from unittest.mock import patch
 
 from proteus import Model
 from trytond.modules.account.tests.tools import (create_chart,
@@ -8,8 +13,10 @@ from trytond.modules.account.tests.tools import (create_chart,
 from trytond.modules.account_invoice.tests.tools import (
     create_payment_term, set_fiscalyear_invoice_sequences)
 from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.pool import Pool
 from trytond.tests.test_tryton import drop_db
 from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
 
 
 class Test(unittest.TestCase):
@@ -25,7 +32,7 @@ class Test(unittest.TestCase):
     def test(self):
 
         # Install stock_value, sale and purchase Modules
-        activate_modules(['stock_valued', 'sale', 'purchase',
+        config = activate_modules(['stock_valued', 'sale', 'purchase',
             'sale_discount', 'purchase_discount'])
 
         # Create company
@@ -197,6 +204,31 @@ class Test(unittest.TestCase):
         self.assertEqual(shipment.tax_amount, Decimal('4.50'))
         self.assertEqual(shipment.total_amount, Decimal('49.50'))
 
+        # The valuation of the period is refreshed when done
+        Valuation = Model.get('stock.shipment.valuation')
+        valuation, = Valuation.find([
+                ('shipment_type', '=', 'stock.shipment.out'),
+                ])
+        self.assertEqual(valuation.party, customer)
+        self.assertEqual(valuation.period, shipment.effective_date.replace(
+                day=1))
+        self.assertEqual(valuation.total_amount, Decimal('49.50'))
+        self.assertEqual(valuation.shipment_count, 1)
+        self.assertEqual(valuation.move_count, 1)
+
+        # The cache follows the taxes of the sale lines of the moves
+        with Transaction().start(config.database_name, 0,
+                context={'company': company.id}) as transaction:
+            SaleLine = Pool().get('sale.line')
+            SaleLine.write([SaleLine(line.id)], {
+                    'taxes': [('remove', [tax.id])],
+                    })
+            transaction.commit()
+        shipment.reload()
+        self.assertEqual(shipment.untaxed_amount_cache, Decimal('45.00'))
+        self.assertEqual(shipment.tax_amount_cache, Decimal('0'))
+        self.assertEqual(shipment.total_amount_cache, Decimal('45.00'))
+
         # Create Supplier Shipment
         Location = Model.get('stock.location')
         supplier_loc, = Location.find([('type', '=', 'supplier')], limit=1)
@@ -222,6 +254,22 @@ class Test(unittest.TestCase):
         self.assertEqual(move.base_price, None)
         self.assertEqual(len(move.taxes), 1)
 
+        # Search and sort supplier shipments by amounts
+        shipments = ShipmentIn.find([
+                ('untaxed_amount', '>', Decimal('10')),
+                ])
+        self.assertEqual(
+            [s.untaxed_amount for s in shipments], [Decimal('20.60')])
+        shipments = ShipmentIn.find([
+                ('total_amount', '<', Decimal('10')),
+                ])
+        self.assertEqual(
+            [s.total_amount for s in shipments], [Decimal('1.10')])
+        shipments = ShipmentIn.find([], order=[('total_amount', 'ASC')])
+        self.assertEqual(
+            [s.total_amount for s in shipments],
+            [Decimal('1.10'), Decimal('22.66')])
+
         # Create Customer Shipment
         ShipmentOut = Model.get('stock.shipment.out')
         customer_loc, = Location.find([('type', '=', 'customer')], limit=1)
@@ -272,6 +320,170 @@ class Test(unittest.TestCase):
         self.assertEqual(move.base_price, None)
         self.assertEqual(len(move.taxes), 0)
 
+        # Create Supplier Return Shipment
+        ShipmentInReturn = Model.get('stock.shipment.in.return')
+        warehouse_loc, = Location.find([('type', '=', 'warehouse')])
+        shipment = ShipmentInReturn()
+        shipment.supplier = supplier
+        shipment.from_location = warehouse_loc.storage_location
+        shipment.to_location = supplier_loc
+        move = Move()
+        shipment.moves.append(move)
+        move.product = product
+        move.unit = unit
+        move.quantity = 2
+        move.from_location = warehouse_loc.storage_location
+        move.to_location = supplier_loc
+        move.company = company
+        move.unit_price = Decimal('1')
+        move.currency = company.currency
+        shipment.save()
+        self.assertEqual(shipment.untaxed_amount, Decimal('2.00'))
+        # move has not origin and is not from a supplier; not taxes
+        self.assertEqual(shipment.tax_amount, Decimal('0'))
+        self.assertEqual(shipment.total_amount, Decimal('2.00'))
+
+        # The amounts cache follows the moves of the shipment
+        shipment = ShipmentIn()
+        shipment.supplier = supplier
+        for quantity in [1, 2]:
+            incoming_move = shipment.incoming_moves.new()
+            incoming_move.product = product
+            incoming_move.unit = unit
+            incoming_move.quantity = quantity
+            incoming_move.from_location = supplier_loc
+            incoming_move.to_location = shipment.warehouse.input_location
+            incoming_move.company = company
+            incoming_move.unit_price = Decimal('1')
+            incoming_move.currency = company.currency
+        shipment.save()
+        self.assertEqual(shipment.untaxed_amount_cache, Decimal('3.00'))
+        self.assertEqual(shipment.tax_amount_cache, Decimal('0.30'))
+        self.assertEqual(shipment.total_amount_cache, Decimal('3.30'))
+        move, other_move = sorted(
+            shipment.incoming_moves, key=lambda m: m.quantity)
+
+        # Writing the other fields of the moves keeps the cache valid
+        move.planned_date = datetime.date.today() + datetime.timedelta(days=1)
+        move.save()
+        with Transaction().start(config.database_name, 0):
+            Shipment = Pool().get('stock.shipment.in')
+            self.assertEqual(Shipment._get_stale_cache([shipment.id]), set())
+
+        move.quantity = 3
+        move.save()
+        shipment.reload()
+        self.assertEqual(shipment.untaxed_amount_cache, Decimal('5.00'))
+        self.assertEqual(shipment.total_amount_cache, Decimal('5.50'))
+        other_move.click('cancel')
+        shipment.reload()
+        self.assertEqual(shipment.untaxed_amount_cache, Decimal('3.00'))
+        self.assertEqual(shipment.total_amount_cache, Decimal('3.30'))
+        move.delete()
+        shipment.reload()
+        self.assertEqual(shipment.untaxed_amount_cache, Decimal('0'))
+        self.assertEqual(shipment.total_amount_cache, Decimal('0'))
+
+        # Rebuild the missing cache except for the pending shipments
+        with Transaction().start(config.database_name, 0,
+                context={'company': company.id}):
+            pool = Pool()
+            Shipment = pool.get('stock.shipment.in')
+            Queue = pool.get('ir.queue')
+            shipments = Shipment.search([], order=[('id', 'ASC')])
+            self.assertGreaterEqual(len(shipments), 3)
+            amounts = Shipment._compute_amounts(shipments)
+            pending, *others, valid = shipments
+            Shipment.reset_cache([pending] + others)
+            Shipment.__queue__.store_cache([pending])
+            tasks = Queue.search([])
+
+            Shipment.rebuild_cache()
+            new_tasks = Queue.search([('id', 'not in', [t.id for t in tasks])])
+            rebuilt = []
+            for task in new_tasks:
+                self.assertEqual(task.data['model'], 'stock.shipment.in')
+                self.assertEqual(task.data['method'], 'store_cache')
+                rebuilt.extend(task.data['instances'])
+            self.assertEqual(rebuilt, [s.id for s in others])
+
+            for task in new_tasks:
+                task.run()
+            for shipment in Shipment.browse([s.id for s in others]):
+                self.assertEqual(
+                    shipment.untaxed_amount_cache,
+                    amounts['untaxed_amount'][shipment.id])
+                self.assertEqual(
+                    shipment.tax_amount_cache,
+                    amounts['tax_amount'][shipment.id])
+                self.assertEqual(
+                    shipment.total_amount_cache,
+                    amounts['total_amount'][shipment.id])
+            self.assertEqual(Shipment._get_stale_cache(
+                    [s.id for s in others + [valid]]), set())
+            pending = Shipment(pending.id)
+            self.assertEqual(pending.untaxed_amount_cache, None)
+
+        # Export the valuation of the shipments and of their moves
+        with Transaction().start(config.database_name, 0,
+                context={'company': company.id}):
+            pool = Pool()
+            Shipment = pool.get('stock.shipment.in')
+            Move = pool.get('stock.move')
+            shipments = Shipment.search([], order=[('id', 'ASC')])
+            amounts = Shipment._compute_amounts(shipments)
+            no_cache, *cached = shipments
+            Shipment.reset_cache([no_cache])
+
+            _compute_amounts = Shipment._compute_amounts
+            computed = []
+
+            def compute_amounts(cls, shipments):
+                computed.extend(s.id for s in shipments)
+                return _compute_amounts(shipments)
+
+            with patch.object(Shipment, '_compute_amounts',
+                    classmethod(compute_amounts)):
+                rows = list(Shipment.get_valuation_rows(chunk=2))
+            self.assertEqual(computed, [no_cache.id])
+            self.assertEqual(
+                [r['id'] for r in rows], [s.id for s in shipments])
+            for row in rows:
+                self.assertEqual(row['model'], 'stock.shipment.in')
+                for name in ['untaxed_amount', 'tax_amount', 'total_amount']:
+                    self.assertEqual(row[name], amounts[name][row['id']])
+
+            file = io.StringIO()
+            Shipment.export_valuation(
+                file, domain=[('id', '=', no_cache.id)])
+            file.seek(0)
+            row, = csv.DictReader(file)
+            self.assertEqual(row['id'], str(no_cache.id))
+            self.assertEqual(
+                row['untaxed_amount'],
+                str(amounts['untaxed_amount'][no_cache.id]))
+            self.assertEqual(
+                row['total_amount'],
+                str(amounts['total_amount'][no_cache.id]))
+
+            moves = Move.search([
+                    ('shipment', '=', str(no_cache)),
+                    ], order=[('id', 'ASC')])
+            self.assertTrue(moves)
+            file = io.StringIO()
+            Move.export_valuation(
+                file, format='jsonl',
+                domain=[('shipment', '=', str(no_cache))], chunk=1)
+            rows = [json.loads(line) for line in file.getvalue().splitlines()]
+            self.assertEqual([r['id'] for r in rows], [m.id for m in moves])
+            for row, move in zip(rows, moves):
+                self.assertEqual(row['shipment'], str(no_cache))
+                self.assertEqual(row['amount'], str(move.amount))
+                self.assertEqual(row['unit_price'], str(move.unit_price))
+
+            with self.assertRaises(ValueError):
+                Shipment.export_valuation(io.StringIO(), format='xml')
+
         # Create Internal Shipment
         storage_location, = Location.find([('type', '=', 'storage')], limit=1)
         new_loc = Location()
@@ -0,0 +1,193 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import defaultdict
+from dateutil.relativedelta import relativedelta
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Coalesce
+from trytond import backend
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids, sqlite_apply_types
+from trytond.transaction import Transaction, without_check_access
+from trytond.modules.currency.fields import Monetary
+
+from .shipment import MOVES, ShipmentValuedMixin
+
+
+class ShipmentValuation(ModelSQL, ModelView):
+    __name__ = 'stock.shipment.valuation'
+    company = fields.Many2One('company.company', "Company", required=True,
+        readonly=True)
+    shipment_type = fields.Selection('get_shipment_types', "Shipment Type",
+        required=True, readonly=True)
+    period = fields.Date("Period", required=True, readonly=True,
+        help="The first day of the month of the effective date.")
+    warehouse = fields.Many2One('stock.location', "Warehouse", readonly=True)
+    party = fields.Many2One('party.party', "Party", readonly=True)
+    currency = fields.Many2One('currency.currency', "Currency",
+        required=True, readonly=True)
+    untaxed_amount = Monetary("Untaxed", digits='currency',
+        currency='currency', readonly=True)
+    tax_amount = Monetary("Tax", digits='currency', currency='currency',
+        readonly=True)
+    total_amount = Monetary("Total", digits='currency', currency='currency',
+        readonly=True)
+    shipment_count = fields.Integer("Shipments", readonly=True)
+    move_count = fields.Integer("Moves", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.company, Index.Equality()),
+                (t.shipment_type, Index.Equality(cardinality='low')),
+                (t.period, Index.Range())))
+        cls._order.insert(0, ('period', 'DESC'))
+
+    @classmethod
+    def get_shipment_types(cls):
+        pool = Pool()
+        Model = pool.get('ir.model')
+        return [(n, Model.get_name(n)) for n in MOVES
+            if issubclass(pool.get(n), ShipmentValuedMixin)]
+
+    @classmethod
+    def refresh(cls, shipments):
+        "Refresh the valuation of the warehouses and parties of the shipments"
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        shipment_ids = defaultdict(list)
+        for shipment in shipments:
+            shipment_ids[shipment.__name__].append(shipment.id)
+        for shipment_type, ids in shipment_ids.items():
+            Shipment = pool.get(shipment_type)
+            table = Shipment.__table__()
+            from_, warehouse, party = Shipment._get_valuation_columns(table)
+            keys = defaultdict(set)
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*from_.select(
+                        table.company, table.effective_date, warehouse, party,
+                        where=reduce_ids(table.id, sub_ids)
+                        & (table.effective_date != Null),
+                        group_by=[
+                            table.company, table.effective_date,
+                            warehouse, party]))
+                for company_id, date, warehouse_id, party_id in cursor:
+                    keys[company_id, date.replace(day=1)].add(
+                        (warehouse_id, party_id))
+            for (company_id, period), sub_keys in keys.items():
+                cls._refresh(shipment_type, company_id, period, sub_keys)
+
+    @classmethod
+    def rebuild(cls):
+        "Refresh the valuation of all the periods with done shipments"
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+        for shipment_type, _ in cls.get_shipment_types():
+            Shipment = pool.get(shipment_type)
+            table = Shipment.__table__()
+            cursor.execute(*table.select(
+                    table.company, table.effective_date,
+                    where=(table.state == 'done')
+                    & (table.effective_date != Null),
+                    group_by=[table.company, table.effective_date]))
+            keys = {(c, d.replace(day=1)) for c, d in cursor}
+            for company_id, period in keys:
+                cls._refresh(shipment_type, company_id, period)
+
+    @classmethod
+    @without_check_access
+    def _refresh(cls, shipment_type, company_id, period, keys=None):
+        '''
+        Refresh the valuation of the period for the keys of warehouse and
+        party or for all of them if keys is None
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Shipment = pool.get(shipment_type)
+        cursor = Transaction().connection.cursor()
+        table = Shipment.__table__()
+        from_, warehouse, party = Shipment._get_valuation_columns(table)
+
+        def done_in_period(table):
+            return ((table.company == company_id)
+                & (table.state == 'done')
+                & (table.effective_date >= period)
+                & (table.effective_date < period + relativedelta(months=1)))
+
+        where = done_in_period(table)
+        domain = [
+            ('company', '=', company_id),
+            ('shipment_type', '=', shipment_type),
+            ('period', '=', period),
+            ]
+        if keys is not None:
+            in_keys = Literal(False)
+            for warehouse_id, party_id in keys:
+                in_keys |= (
+                    (warehouse == warehouse_id if warehouse_id is not None
+                        else warehouse == Null)
+                    & (party == party_id if party_id is not None
+                        else party == Null))
+            where &= in_keys
+            domain.append(['OR'] + [[
+                        ('warehouse', '=', warehouse_id),
+                        ('party', '=', party_id),
+                        ] for warehouse_id, party_id in keys])
+
+        # The amounts are summed from the cache so it must be up to date
+        cursor.execute(*from_.select(table.id,
+                where=where & Shipment._get_cache_invalid(table)))
+        ids = [i for i, in cursor]
+        if ids:
+            Shipment.store_cache(Shipment.browse(ids))
+
+        move, shipment, moves_from, moves_where = (
+            Shipment._get_valued_moves_query())
+        moves = moves_from.select(
+            shipment.id.as_('shipment'), Count(Literal('*')).as_('count'),
+            where=moves_where & done_in_period(shipment),
+            group_by=shipment.id)
+        query = from_.join(moves, 'LEFT',
+            condition=moves.shipment == table.id
+            ).select(
+                warehouse.as_('warehouse'),
+                party.as_('party'),
+                Sum(Coalesce(table.untaxed_amount_cache, 0)).as_(
+                    'untaxed_amount'),
+                Sum(Coalesce(table.tax_amount_cache, 0)).as_('tax_amount'),
+                Sum(Coalesce(table.total_amount_cache, 0)).as_(
+                    'total_amount'),
+                Count(Literal('*')).as_('shipment_count'),
+                Sum(Coalesce(moves.count, 0)).as_('move_count'),
+                where=where,
+                group_by=[warehouse, party])
+        if backend.name == 'sqlite':
+            sqlite_apply_types(
+                query, [None, None, 'NUMERIC', 'NUMERIC', 'NUMERIC', None, None])
+        cursor.execute(*query)
+
+        currency = Company(company_id).currency
+        to_create = []
+        for (warehouse_id, party_id, untaxed_amount, tax_amount, total_amount,
+                shipment_count, move_count) in cursor:
+            to_create.append({
+                    'company': company_id,
+                    'shipment_type': shipment_type,
+                    'period': period,
+                    'warehouse': warehouse_id,
+                    'party': party_id,
+                    'currency': currency.id,
+                    'untaxed_amount': currency.round(untaxed_amount),
+                    'tax_amount': currency.round(tax_amount),
+                    'total_amount': currency.round(total_amount),
+                    'shipment_count': shipment_count,
+                    'move_count': move_count,
+                    })
+        cls.delete(cls.search(domain))
+        if to_create:
+            cls.create(to_create)